@@ -0,0 +1,17 @@
+import os
+
+from setuptools import build_meta
+from setuptools.build_meta import *  # noqa: F401,F403
+
+
+# Only builds that ask for the compiled parser with HACKERSLIDES_CYTHON=1 need Cython
+def _cython_requirements():
+    return ['Cython'] if os.environ.get('HACKERSLIDES_CYTHON') == '1' else []
+
+
+def get_requires_for_build_wheel(config_settings=None):
+    return build_meta.get_requires_for_build_wheel(config_settings) + _cython_requirements()
+
+
+def get_requires_for_build_editable(config_settings=None):
+    return build_meta.get_requires_for_build_editable(config_settings) + _cython_requirements()
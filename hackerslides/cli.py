@@ -1,20 +1,22 @@
 import logging
 import re
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Tuple
 
 from hackerslides.model import Configuration
-from .parser import parse, ParsingError
+from .parser import parse_lines, ParsingError
 from .renderer import ImageMagickRenderer
 
+RESOLUTION_PATTERN = re.compile(r'^(\d+)x(\d+)$')
+
 
 def main():
     config = parse_config()
 
     with open(config.path) as f:
-        source = f.read()
         try:
-            presentation = parse(source)
+            presentation = parse_lines(f)
         except ParsingError as e:
             print(e)
             sys.exit(1)
@@ -26,24 +28,31 @@ def main():
 def parse_config():
     parser = ArgumentParser()
     parser.add_argument('path', help='Path to hackerslides file')
-    parser.add_argument('--resolution', default='1920x1080', metavar='WIDTHxHEIGHT')
+    parser.add_argument('--resolution', default='1920x1080', metavar='WIDTHxHEIGHT', type=parse_resolution)
+    parser.add_argument('--opencl', default=False, action='store_true',
+                        help='Let ImageMagick use OpenCL acceleration on the GPU, if it was built with it')
+    parser.add_argument('--refresh-fonts', default=False, action='store_true',
+                        help='List the installed fonts again instead of using the cached list')
     parser.add_argument('-v', '--verbose', default=False, action='store_true')
 
     parsed_args = parser.parse_args()
 
     configure_logging(parsed_args.verbose)
 
-    def _parse_resolution(resolution):
-        m = re.match(r'^(\d+)x(\d+)$', resolution)
-        if not m:
-            parser.error('Resolution must be specified as WIDTHxHEIGHT')
-        return int(m[1]), int(m[2])
-
     return Configuration(
         path=parsed_args.path,
-        resolution=_parse_resolution(parsed_args.resolution)
+        resolution=parsed_args.resolution,
+        opencl=parsed_args.opencl,
+        refresh_fonts=parsed_args.refresh_fonts,
     )
 
 
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    m = RESOLUTION_PATTERN.match(resolution)
+    if not m:
+        raise ArgumentTypeError('Resolution must be specified as WIDTHxHEIGHT')
+    return int(m[1]), int(m[2])
+
+
 def configure_logging(verbose: bool):
     logging.basicConfig(format='%(levelname)-8s %(message)s', level=logging.DEBUG if verbose else logging.INFO)
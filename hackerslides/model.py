@@ -1,6 +1,11 @@
-from dataclasses import dataclass
+import sys
+from dataclasses import dataclass, field, fields, replace
 from enum import Enum
-from typing import Optional, Union, List, Tuple
+from typing import Optional, Union, Tuple
+
+
+# dataclass only accepts slots=True from Python 3.10 on
+_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
 
 
 class SlideStyle(Enum):
@@ -8,7 +13,7 @@ class SlideStyle(Enum):
     MEME = 'meme'
 
 
-@dataclass
+@dataclass(frozen=True, **_SLOTS)
 class SlideOptions:
     background: Optional[str] = None
     foreground: Optional[str] = None
@@ -16,35 +21,50 @@ class SlideOptions:
     style: Optional[SlideStyle] = None
     scale: Optional[float] = None
 
+    def with_default(self, default: 'SlideOptions') -> 'SlideOptions':
+        overrides = {f.name: getattr(self, f.name) for f in fields(self) if getattr(self, f.name) is not None}
+        # Options are frozen, so slides without overrides can share the default instance
+        if not overrides:
+            return default
+        return replace(default, **overrides)
 
-@dataclass
+
+@dataclass(frozen=True, **_SLOTS)
 class TextSlide:
     text: str
-    options: SlideOptions = SlideOptions()
+    options: SlideOptions = field(default_factory=SlideOptions)
 
 
-@dataclass
+@dataclass(frozen=True, **_SLOTS)
 class ImageSlide:
     image_path: str
     text: Optional[str] = None
-    options: SlideOptions = SlideOptions()
+    options: SlideOptions = field(default_factory=SlideOptions)
+    # The lines of text, derived from text unless the parser already split them
+    text_lines: Tuple[str, ...] = field(default=(), compare=False, repr=False)
 
+    def __post_init__(self):
+        if self.text is not None and not self.text_lines:
+            object.__setattr__(self, 'text_lines', tuple(self.text.splitlines(keepends=False)))
 
-@dataclass
+
+@dataclass(frozen=True, **_SLOTS)
 class CodeSlide:
     code_path: str
-    options: SlideOptions = SlideOptions()
+    options: SlideOptions = field(default_factory=SlideOptions)
 
 
 Slide = Union[TextSlide, ImageSlide, CodeSlide]
 
 
-@dataclass
+@dataclass(frozen=True, **_SLOTS)
 class Presentation:
-    slides: List[Slide]
+    slides: Tuple[Slide, ...]
 
 
 @dataclass
 class Configuration:
     path: str
     resolution: Tuple[int, int]
+    opencl: bool = False
+    refresh_fonts: bool = False
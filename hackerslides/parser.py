@@ -1,5 +1,8 @@
+import io
+import sys
 from dataclasses import dataclass
-from typing import List, Union, Tuple
+from functools import lru_cache
+from typing import List, Union, Tuple, Iterable, Iterator, Set
 
 from .model import Presentation, Slide, TextSlide, ImageSlide, SlideOptions, SlideStyle, CodeSlide
 
@@ -13,43 +16,48 @@ DEFAULT_SLIDE_OPTIONS = SlideOptions(
     style=SlideStyle.DEFAULT,
     scale=1,
 )
+EMPTY_SLIDE_OPTIONS = SlideOptions()
 
 
-@dataclass
-class RawLine:
-    value: str
-    index: int
-
-
-@dataclass
+@dataclass(frozen=True)
 class TextLine:
+    __slots__ = ('text', 'index')
+
     text: str
     index: int
     name = 'Text line'
 
 
-@dataclass
+@dataclass(frozen=True)
 class IncludeImageLine:
+    __slots__ = ('path', 'index')
+
     path: str
     index: int
     name = f'{IMG_KEYWORD} statement'
 
 
-@dataclass
+@dataclass(frozen=True)
 class IncludeCodeLine:
+    __slots__ = ('path', 'index')
+
     path: str
     index: int
     name = f'{CODE_KEYWORD} statement'
 
 
-@dataclass
+@dataclass(frozen=True)
 class EmptyLine:
+    __slots__ = ('index',)
+
     index: int
     name = 'empty line'
 
 
-@dataclass
+@dataclass(frozen=True)
 class OptionLine:
+    __slots__ = ('key', 'args', 'index')
+
     key: str
     args: List[str]
     index: int
@@ -58,109 +66,133 @@ class OptionLine:
 ParsedLine = Union[EmptyLine, TextLine, IncludeImageLine, IncludeCodeLine, OptionLine]
 
 
+# Presentations are immutable, so parsing the same source again can return the same object
+@lru_cache(maxsize=256)
 def parse(source: str) -> Presentation:
-    lines = _filter_comments(_split_into_lines(source))
-    parsed_lines = [_parse_line(line) for line in lines]
-    chunks = _split_into_chunks(parsed_lines)
-
-    if _is_option_only_chunk(chunks[0]):
-        _, presentation_options = _parse_options(chunks.pop(0))
-    else:
-        presentation_options = SlideOptions()
-    presentation_default_slide_options = _with_fallback(presentation_options, DEFAULT_SLIDE_OPTIONS)
+    # Split like a file opened in text mode, so that parse_lines(file) yields the same slides and line numbers
+    return parse_lines(io.StringIO(source, newline=None))
+
+
+def parse_lines(lines: Iterable[str]) -> Presentation:
+    return Presentation(slides=tuple(_iter_slides(lines)))
+
+
+def _iter_slides(lines: Iterable[str]) -> Iterator[Slide]:
+    presentation_default_slide_options = None
+    for chunk, line_types in _iter_chunks(lines):
+        if presentation_default_slide_options is None:
+            if line_types == {OptionLine}:
+                _, presentation_options = _parse_options(chunk)
+                presentation_default_slide_options = presentation_options.with_default(DEFAULT_SLIDE_OPTIONS)
+                continue
+            presentation_default_slide_options = DEFAULT_SLIDE_OPTIONS
+        yield _parse_chunk_to_slide(chunk, line_types, presentation_default_slide_options)
+
+
+def _iter_chunks(lines: Iterable[str]) -> Iterator[Tuple[List[ParsedLine], Set[type]]]:
+    chunk = []
+    # Collected while building the chunk, so deciding the kind of slide needs no further pass over it
+    line_types = set()
+    for i, value in enumerate(lines):
+        if _is_comment(value):
+            continue
+        line = _parse_line(value.rstrip('\n'), i)
+        if isinstance(line, EmptyLine):
+            if len(chunk) > 0:
+                yield chunk, line_types
+                chunk, line_types = [], set()
+        else:
+            _check_line_fits_chunk(line, line_types)
+            chunk.append(line)
+            line_types.add(type(line))
+    if len(chunk) > 0:
+        yield chunk, line_types
+
+
+def _check_line_fits_chunk(line: ParsedLine, line_types: Set[type]):
+    # Fail on the offending line instead of collecting the rest of a code slide that can only be rejected. The rest
+    # of the chunk is unknown here, so a chunk starting with @code is treated as a code slide even if an @img follows.
+    # Image slides are validated once complete, as the meme line limit depends on options that may come later.
+    if IncludeCodeLine in line_types and IncludeImageLine not in line_types:
+        if isinstance(line, IncludeCodeLine):
+            raise ParsingError(line.index, f'Only one {CODE_KEYWORD} statement per slide is allowed')
+        elif isinstance(line, TextLine):
+            raise ParsingError(line.index, f'{line.name} not supported in code slide')
 
-    slides = [_parse_chunk_to_slide(chunk, presentation_default_slide_options) for chunk in chunks]
 
-    return Presentation(slides=slides)
+def _parse_line(value: str, index: int) -> ParsedLine:
+    line_parser = _LINE_PARSERS.get(value[:1])
+    if line_parser is not None:
+        return line_parser(value, index)
+    elif not value or value.isspace():
+        return EmptyLine(index)
+    else:
+        return TextLine(value, index)
 
 
-def _split_into_lines(source: str) -> List[RawLine]:
-    return [RawLine(line, i) for i, line in enumerate(source.splitlines(keepends=False))]
+def _parse_statement(value: str, index: int) -> ParsedLine:
+    keyword, *args = value.split()
+    statement_parser = _STATEMENT_PARSERS.get(keyword)
+    if statement_parser is None:
+        raise ParsingError(index, f'Unknown keyword {keyword}')
+    return statement_parser(args, index)
 
 
-def _parse_line(line: RawLine) -> ParsedLine:
-    if line.value.startswith('@'):
-        keyword, *args = line.value.split()
-        if keyword == IMG_KEYWORD:
-            if len(args) == 0:
-                raise ParsingError(line.index, f'No path given in {IMG_KEYWORD} statement')
-            path = args[0]
-            return IncludeImageLine(path, line.index)
-        elif keyword == CODE_KEYWORD:
-            if len(args) == 0:
-                raise ParsingError(line.index, f'No path given in {CODE_KEYWORD} statement')
-            path = args[0]
-            return IncludeCodeLine(path, line.index)
-        else:
-            raise ParsingError(line.index, f'Unknown keyword {keyword}')
-    elif line.value.startswith(':'):
-        return _parse_option(line)
-    elif line.value.startswith('\\'):
-        return TextLine(line.value[1:], line.index)
-    elif line.value.strip() == '':
-        return EmptyLine(line.index)
-    else:
-        return TextLine(line.value, line.index)
-
-
-def _parse_option(line: RawLine) -> OptionLine:
-    keyword, *args = line.value.split()
-    if keyword in [':fg', ':bg', ':scale', ':style']:
-        if len(args) != 1:
-            raise ParsingError(line.index, f'Expected one argument for {keyword} statement')
-        return OptionLine(keyword[1:], args, line.index)
-    elif keyword in [':cover', ':nocover', ':nostyle']:
-        if len(args) != 0:
-            raise ParsingError(line.index, f'Expected no argument for {keyword} statement')
-        return OptionLine(keyword[1:], args, line.index)
-    else:
-        raise ParsingError(line.index, f'Unknown keyword {keyword}')
+def _parse_escaped_text(value: str, index: int) -> TextLine:
+    return TextLine(value[1:], index)
 
 
-def _parse_chunk_to_slide(chunk: List[ParsedLine], presentation_default_slide_options) -> Slide:
-    chunk, options = _parse_options(chunk)
-    if _is_image_chunk(chunk):
-        slide = _parse_image_chunk(chunk, is_meme=options.style == SlideStyle.MEME)
-    elif _is_code_chunk(chunk):
-        slide = _parse_code_chunk(chunk)
-    else:
-        slide = TextSlide(_strip_escape_char_and_join(chunk))
-    slide.options = _with_fallback(options, presentation_default_slide_options)
-    return slide
+def _parse_image_statement(args: List[str], index: int) -> IncludeImageLine:
+    if len(args) == 0:
+        raise ParsingError(index, f'No path given in {IMG_KEYWORD} statement')
+    return IncludeImageLine(args[0], index)
 
 
-def _split_into_chunks(lines: List[ParsedLine]) -> List[List[ParsedLine]]:
-    current_chunk = []
-    all_chunks = []
+def _parse_code_statement(args: List[str], index: int) -> IncludeCodeLine:
+    if len(args) == 0:
+        raise ParsingError(index, f'No path given in {CODE_KEYWORD} statement')
+    return IncludeCodeLine(args[0], index)
 
-    def finish_chunk():
-        nonlocal current_chunk
-        if len(current_chunk) > 0:
-            all_chunks.append(current_chunk)
-            current_chunk = []
 
-    for line in lines:
-        if isinstance(line, EmptyLine):
-            finish_chunk()
-        else:
-            current_chunk.append(line)
-    finish_chunk()
-    return all_chunks
+_STATEMENT_PARSERS = {
+    IMG_KEYWORD: _parse_image_statement,
+    CODE_KEYWORD: _parse_code_statement,
+}
 
 
-def _is_option_only_chunk(chunk: List[ParsedLine]):
-    return all([isinstance(line, OptionLine) for line in chunk])
+def _parse_option(value: str, index: int) -> OptionLine:
+    keyword, *args = value.split()
+    option = _OPTIONS.get(keyword[1:])
+    if option is None:
+        raise ParsingError(index, f'Unknown keyword {keyword}')
+    argument_count, _ = option
+    if len(args) != argument_count:
+        expected = 'one argument' if argument_count == 1 else 'no argument'
+        raise ParsingError(index, f'Expected {expected} for {keyword} statement')
+    return OptionLine(keyword[1:], args, index)
 
 
-def _is_image_chunk(chunk: List[ParsedLine]):
-    return any([isinstance(line, IncludeImageLine) for line in chunk])
+_LINE_PARSERS = {
+    '@': _parse_statement,
+    ':': _parse_option,
+    '\\': _parse_escaped_text,
+}
 
 
-def _is_code_chunk(chunk: List[ParsedLine]):
-    return any([isinstance(line, IncludeCodeLine) for line in chunk])
+def _parse_chunk_to_slide(chunk: List[ParsedLine], line_types: Set[type],
+                          presentation_default_slide_options) -> Slide:
+    chunk, options = _parse_options(chunk)
+    options = options.with_default(presentation_default_slide_options)
+    if IncludeImageLine in line_types:
+        return _parse_image_chunk(chunk, options)
+    elif IncludeCodeLine in line_types:
+        return _parse_code_chunk(chunk, options)
+    else:
+        return TextSlide(_strip_escape_char_and_join(chunk), options=options)
 
 
-def _parse_image_chunk(chunk: List[ParsedLine], is_meme: bool):
+def _parse_image_chunk(chunk: List[ParsedLine], options: SlideOptions):
+    is_meme = options.style == SlideStyle.MEME
     image_path = None
     text = []
     for line in chunk:
@@ -175,24 +207,21 @@ def _parse_image_chunk(chunk: List[ParsedLine], is_meme: bool):
             text.append(line)
         else:
             raise ParsingError(line.index, f'{line.name} not supported in image slide')
-    return ImageSlide(image_path=image_path, text=_strip_escape_char_and_join(text) or None)
+    text_lines = tuple(_strip_escape_char_for_line(line.text) for line in text)
+    joined_text = '\n'.join(text_lines) or None
+    return ImageSlide(image_path=image_path, text=joined_text, options=options,
+                      text_lines=text_lines if joined_text else ())
 
 
-def _parse_code_chunk(chunk: List[ParsedLine]):
-    code_path = None
-    for line in chunk:
-        if isinstance(line, IncludeCodeLine):
-            if code_path is not None:
-                raise ParsingError(line.index, f'Only one {CODE_KEYWORD} statement per slide is allowed')
-            code_path = line.path
-            # todo validate file exists
-        else:
-            raise ParsingError(line.index, f'{line.name} not supported in code slide')
-    return CodeSlide(code_path=code_path)
+def _parse_code_chunk(chunk: List[ParsedLine], options: SlideOptions):
+    # Anything besides the single @code statement was already rejected by _check_line_fits_chunk
+    code_line, = chunk
+    # todo validate file exists
+    return CodeSlide(code_path=code_line.path, options=options)
 
 
-def _filter_comments(lines: List[RawLine]) -> List[RawLine]:
-    return [line for line in lines if not line.value.startswith('#')]
+def _is_comment(line: str) -> bool:
+    return line.startswith('#')
 
 
 def _strip_escape_char_and_join(chunk: List[TextLine]) -> str:
@@ -204,43 +233,51 @@ def _strip_escape_char_for_line(line: str) -> str:
 
 
 def _parse_options(chunk: List[ParsedLine]) -> Tuple[List[ParsedLine], SlideOptions]:
-    options = SlideOptions()
+    overrides = {}
     filtered_lines = []
     for line in chunk:
         if isinstance(line, OptionLine):
-            if line.key == 'fg':
-                options.foreground = line.args[0]
-            elif line.key == 'bg':
-                options.background = line.args[0]
-            elif line.key == 'scale':
-                options.scale = float(line.args[0])
-            elif line.key == 'cover':
-                options.cover = True
-            elif line.key == 'nocover':
-                options.cover = False
-            elif line.key == 'style':
-                if line.args[0] == 'meme':
-                    options.style = SlideStyle.MEME
-                else:
-                    raise ParsingError(line.index, f'Unknown style {line.args[0]}')
-                options.meme = True
-            elif line.key == 'nostyle':
-                options.style = SlideStyle.DEFAULT
-            else:
-                raise ValueError(f'Unsupported option key {line.key}')
+            # Unknown keys were already rejected by _parse_option
+            _, handler = _OPTIONS[line.key]
+            field_name, value = handler(line)
+            overrides[field_name] = value
         else:
             filtered_lines.append(line)
+    # Most slides set no options, so share a single empty instance between them
+    options = SlideOptions(**overrides) if overrides else EMPTY_SLIDE_OPTIONS
     return filtered_lines, options
 
 
-def _with_fallback(options: SlideOptions, fallback: SlideOptions) -> SlideOptions:
-    return SlideOptions(
-        fallback.background if options.background is None else options.background,
-        fallback.foreground if options.foreground is None else options.foreground,
-        fallback.cover if options.cover is None else options.cover,
-        fallback.style if options.style is None else options.style,
-        fallback.scale if options.scale is None else options.scale,
-    )
+_STYLES = {style.value: style for style in SlideStyle}
+
+
+def _parse_style(line: OptionLine) -> Tuple[str, SlideStyle]:
+    style = _STYLES.get(line.args[0])
+    if style is None:
+        raise ParsingError(line.index, f'Unknown style {line.args[0]}')
+    return 'style', style
+
+
+def _parse_scale(line: OptionLine) -> Tuple[str, float]:
+    value = line.args[0]
+    # Whole numbers such as the common ":scale 2" take the cheaper int conversion
+    try:
+        return 'scale', int(value) if value.isdigit() else float(value)
+    except ValueError:
+        raise ParsingError(line.index, f'Invalid scale {value}') from None
+
+
+# Option keyword without the leading colon -> (number of arguments, handler returning the field and its value).
+# Colour names repeat across the slides of a deck, so all slides share a single string per colour.
+_OPTIONS = {
+    'fg': (1, lambda line: ('foreground', sys.intern(line.args[0]))),
+    'bg': (1, lambda line: ('background', sys.intern(line.args[0]))),
+    'scale': (1, _parse_scale),
+    'cover': (0, lambda line: ('cover', True)),
+    'nocover': (0, lambda line: ('cover', False)),
+    'style': (1, _parse_style),
+    'nostyle': (0, lambda line: ('style', SlideStyle.DEFAULT)),
+}
 
 
 class ParsingError(Exception):
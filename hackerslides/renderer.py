@@ -1,11 +1,25 @@
+import glob
+import hashlib
+import json
 import os
 import re
 import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from functools import lru_cache
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import logging
 
+from PIL import Image, UnidentifiedImageError
+import pygments
+from pygments import highlight
+from pygments.formatters.img import ImageFormatter
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_for_filename
+from pygments.util import guess_decode
+
 from hackerslides.model import Presentation, Configuration, TextSlide, ImageSlide, Slide, SlideStyle, CodeSlide
 
 
@@ -13,6 +27,26 @@ TEXT_FONTS = ['DejaVu-Sans', 'Roboto', 'Ubuntu']
 CODE_FONTS = ['Source-Code-Pro', 'Ubuntu-Mono', 'DeJaVu-Sans-Mono']
 MEME_FONTS = ['Impact']
 
+MAX_SLIDES_PER_BATCH = 50
+# Bump whenever a change to the renderer alters the output for an unchanged slide
+CACHE_VERSION = 1
+# Renderings no slide has used for this long are removed from the cache
+CACHE_MAX_AGE = 14 * 24 * 60 * 60
+
+FONT_PATTERN = re.compile(r'^\s+Font:\s(.*)$')
+# The font list changes when ImageMagick is upgraded or fontconfig rebuilds its cache after fonts were installed
+FONT_CACHE_DEPENDENCIES = [
+    '/var/cache/fontconfig',
+    '/usr/local/var/cache/fontconfig',
+    '/opt/homebrew/var/cache/fontconfig',
+    os.path.expanduser('~/.cache/fontconfig'),
+    os.path.expanduser('~/Library/Caches/fontconfig'),
+]
+# ...or when ImageMagick or fontconfig are pointed at a different configuration
+FONT_CACHE_ENVIRONMENT = ['MAGICK_CONFIGURE_PATH', 'FONTCONFIG_FILE', 'FONTCONFIG_PATH']
+# Not every installation keeps its caches where the above notices a change, so the list is refreshed regularly anyway
+FONT_CACHE_MAX_AGE = 24 * 60 * 60
+
 
 class Renderer:
 
@@ -24,28 +58,163 @@ class ImageMagickRenderer(Renderer):
 
     def __init__(self, configuration: Configuration):
         self.configuration = configuration
+        if configuration.refresh_fonts:
+            _clear_font_cache()
+        if configuration.opencl:
+            self._enable_opencl()
 
     def render(self, presentation: Presentation):
-        self._recreate_empty_directory('out')
+        self._prepare_directories(len(presentation.slides))
+        cache = SlideCache('out/cache')
+        # The fonts are part of the cache key, so slides rendered before a font was installed are redone.
+        # Resolving them once also keeps the workers from racing to list them.
+        fonts = Fonts(
+            text=_get_best_font(TEXT_FONTS),
+            code=_get_best_font(CODE_FONTS),
+            meme=_get_best_font(MEME_FONTS),
+        )
+        # Only the first of several identical slides needs ImageMagick, and only if no previous run cached it
+        slides = []
+        duplicates = []
+        first_filenames: Dict[str, str] = {}
         for i, slide in enumerate(presentation.slides):
-            ImageMagickSlideRenderer(configuration=self.configuration, slide=slide, slide_index=i).render()
+            key = cache.key(slide, self.configuration.resolution, fonts)
+            filename = _slide_filename(i)
+            if key in first_filenames:
+                duplicates.append((first_filenames[key], filename))
+                continue
+            first_filenames[key] = filename
+            if not cache.restore(key, filename):
+                # The stale file may be a hard link into the cache, which convert must not write through
+                _remove_file(filename)
+                slides.append((i, slide, key))
+
+        if slides:
+            self._render_slides(slides, cache, fonts)
+        for source, target in duplicates:
+            _link_or_copy(source, target)
+        cache.prune()
+
+    def _render_slides(self, slides: List[Tuple[int, Slide, str]], cache: 'SlideCache', fonts: 'Fonts'):
+        # Slides are independent and the time is spent waiting on subprocesses, so threads suffice.
+        # Each worker renders its share of the slides with a single convert invocation, unless the
+        # share is so large that the command line could exceed the operating system's limit.
+        workers = min(os.cpu_count() or 1, len(slides))
+        batch_size = min(MAX_SLIDES_PER_BATCH, -(-len(slides) // workers))
+        batches = [slides[i:i + batch_size] for i in range(0, len(slides), batch_size)]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self._render_batch, batch, cache, fonts) for batch in batches]
+            for future in futures:
+                future.result()
+
+    def _render_batch(self, batch: List[Tuple[int, Slide, str]], cache: 'SlideCache', fonts: 'Fonts'):
+        # Settings such as -fill or -stroke must not leak from one slide into the next
+        command = ['convert', '-respect-parentheses']
+        filename = None
+        for slide_index, slide, _ in batch:
+            if filename is not None:
+                command += ['-write', filename, '+delete']
+            slide_renderer = ImageMagickSlideRenderer(configuration=self.configuration, slide=slide,
+                                                      slide_index=slide_index, fonts=fonts)
+            command.append('(')
+            command += slide_renderer.render()
+            command.append(')')
+            filename = _slide_filename(slide_index)
+        command.append(filename)
+        _exec(command)
+
+        for slide_index, _, key in batch:
+            cache.store(key, _slide_filename(slide_index))
+
+    @staticmethod
+    def _enable_opencl():
+        if not _supports_opencl():
+            logging.warning('ImageMagick was built without OpenCL support, rendering on the CPU')
+            return
+        # Inherited by every convert process started from here on
+        os.environ['MAGICK_OCL_DEVICE'] = 'GPU'
 
     @staticmethod
-    def _recreate_empty_directory(path):
-        if os.path.exists(path):
-            shutil.rmtree(path)
-        os.makedirs(path)
+    def _prepare_directories(slide_count: int):
+        # Code slides are highlighted into tmp/ before being composited
+        for path in ['out', 'tmp']:
+            os.makedirs(path, exist_ok=True)
+        # Slides still present from the previous run are replaced or kept individually
+        slide_filenames = {_slide_filename(i) for i in range(slide_count)}
+        for filename in glob.glob('out/slide_*.png'):
+            if filename not in slide_filenames:
+                os.remove(filename)
+
+
+class SlideCache:
+
+    def __init__(self, path: str):
+        self.path = path
+        self.used_keys = set()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, slide: Slide, resolution: Tuple[int, int], fonts: 'Fonts') -> str:
+        # Besides the slide and its options, the rendering depends on the fonts, the renderer and Pygments,
+        # and the contents of referenced files
+        source_path = _source_path(slide)
+        if source_path is not None and os.path.exists(source_path):
+            stat = os.stat(source_path)
+            source_state = (source_path, stat.st_mtime_ns, stat.st_size)
+        else:
+            source_state = None
+        state = (CACHE_VERSION, pygments.__version__, slide, resolution, fonts, source_state)
+        return hashlib.sha256(repr(state).encode()).hexdigest()
+
+    def restore(self, key: str, filename: str) -> bool:
+        cached_filename = self._cached_filename(key)
+        if not os.path.exists(cached_filename):
+            return False
+        self.used_keys.add(key)
+        if os.path.exists(filename) and os.path.samefile(cached_filename, filename):
+            logging.debug(f'{filename} is up to date')
+            return True
+        logging.debug(f'Using cached rendering {cached_filename} for {filename}')
+        _link_or_copy(cached_filename, filename)
+        return True
+
+    def store(self, key: str, filename: str):
+        _link_or_copy(filename, self._cached_filename(key))
+        self.used_keys.add(key)
+
+    def prune(self):
+        # Every edit of a slide leaves a rendering behind. Those used in this run are marked as fresh and the rest
+        # are kept for a while, so that undoing an edit or switching branches does not mean rendering again.
+        now = time.time()
+        for filename in glob.glob(os.path.join(self.path, '*.png')):
+            key = os.path.splitext(os.path.basename(filename))[0]
+            if key in self.used_keys:
+                os.utime(filename, (now, now))
+            elif os.stat(filename).st_mtime < now - CACHE_MAX_AGE:
+                logging.debug(f'Removing unused cached rendering {filename}')
+                os.remove(filename)
+
+    def _cached_filename(self, key: str) -> str:
+        return os.path.join(self.path, f'{key}.png')
+
+
+@dataclass
+class Fonts:
+    text: Optional[str]
+    code: Optional[str]
+    meme: Optional[str]
 
 
 class ImageMagickSlideRenderer:
 
-    def __init__(self, configuration: Configuration, slide: Slide, slide_index: int):
+    def __init__(self, configuration: Configuration, slide: Slide, slide_index: int, fonts: Fonts):
         self.configuration = configuration
         self.slide = slide
+        self.fonts = fonts
         self.slide_index = slide_index
         self.image_size: Optional[Tuple[int, int]] = None
+        self.geometry = f'{self.width}x{self.height}'
 
-    def render(self):
+    def render(self) -> List[str]:
         if isinstance(self.slide, TextSlide):
             return self._render_text_slide()
         elif isinstance(self.slide, ImageSlide):
@@ -55,52 +224,42 @@ class ImageMagickSlideRenderer:
         else:
             raise ValueError(f'Cannot render unsupported slide {self.slide}')
 
-    def _render_text_slide(self):
-        _exec([
-            *self._render_background(),
-            *self._render_text(),
-            self._slide_filename(),
-        ])
+    def _render_text_slide(self) -> List[str]:
+        command = self._render_background()
+        command += self._render_text()
+        return command
 
-    def _render_image_slide(self):
+    def _render_image_slide(self) -> List[str]:
         self._determine_raw_image_size()
         text_cmd = self._render_meme_text() if self.slide.options.style == SlideStyle.MEME else self._render_text()
-        _exec([
-            *self._render_background(),
-            *self._render_image(),
-            *text_cmd,
-            self._slide_filename(),
-        ])
-
-    def _render_code_slide(self):
+        command = self._render_background()
+        command += self._render_image()
+        command += text_cmd
+        return command
+
+    def _render_code_slide(self) -> List[str]:
         rendered_code_path = self._code_filename()
-        font = _get_best_font(CODE_FONTS)
-        font_line = ['-O', f'font_name={font.replace("-", " ")}'] if font else []
-        _exec([
-            'pygmentize',
-            '-O', 'line_numbers=False',
-            '-O', 'font_size=100',
-            '-O', 'style=vim',
-            '-O', 'image_pad=50',
-            *font_line,
-            '-o', rendered_code_path,
-            self.slide.code_path
-        ])
-        _exec([
-            *self._render_background(),
+        font = self.fonts.code
+        font_options = {'font_name': font.replace('-', ' ')} if font else {}
+        code, lexer = _load_code(self.slide.code_path)
+        # A formatter keeps state while formatting, so each slide gets its own
+        formatter = ImageFormatter(line_numbers=False, font_size=100, style='vim', image_pad=50, **font_options)
+        with open(rendered_code_path, 'wb') as f:
+            f.write(highlight(code, lexer, formatter))
+        command = self._render_background()
+        command += [
             '-background', 'transparent',
             '-gravity', 'Center',
             rendered_code_path,
-            '-adaptive-resize', f'{self.width}x{self.height}',
-            '-extent', f'{self.width}x{self.height}',
+            '-adaptive-resize', self.geometry,
+            '-extent', self.geometry,
             '-composite',
-            self._slide_filename(),
-        ])
+        ]
+        return command
 
     def _render_background(self) -> List[str]:
         return [
-            'convert',
-            '-size', f'{self.width}x{self.height}',
+            '-size', self.geometry,
             f'xc:{self.slide.options.background}',
         ]
 
@@ -108,7 +267,7 @@ class ImageMagickSlideRenderer:
         if self.slide.text is None:
             return []
         w, h = self._scaled_size()
-        font = _get_best_font(TEXT_FONTS)
+        font = self.fonts.text
         font_line = ['-font', font] if font else []
         return [
             '-size', f'{w}x{h}',
@@ -123,17 +282,16 @@ class ImageMagickSlideRenderer:
     def _render_meme_text(self):
         if self.slide.text is None:
             return []
-        lines = self.slide.text.splitlines(keepends=False)
-        if len(lines) > 2:
-            raise ValueError('Cannot render a meme with more than 2 lines of text')
-        elif len(lines) == 1:
+        # The parser already rejects memes with more than 2 lines of text
+        lines = list(self.slide.text_lines)
+        if len(lines) == 1:
             lines.append('')
 
         w, h = self._background_size()
         scaled_h = h / 6 * self.slide.options.scale
         strokewidth = int(min(w, h) * self.slide.options.scale / 100)
         offset_y = int((h - scaled_h) / 2)
-        font = _get_best_font(MEME_FONTS)
+        font = self.fonts.meme
         font_line = ['-font', font] if font else []
         common_options = [
             '-size', f'{w}x{scaled_h}',
@@ -161,8 +319,8 @@ class ImageMagickSlideRenderer:
             '-background', 'transparent',
             '-gravity', 'Center',
             self.slide.image_path,
-            '-resize', f'{self.width}x{self.height}' + ('^' if self.slide.options.cover else ''),
-            '-extent', f'{self.width}x{self.height}',
+            '-resize', self.geometry + ('^' if self.slide.options.cover else ''),
+            '-extent', self.geometry,
             '-composite',
         ]
 
@@ -191,17 +349,53 @@ class ImageMagickSlideRenderer:
         return scaled_w, scaled_h
 
     def _determine_raw_image_size(self):
-        output = _exec(['identify', '-format', '%w %h', self.slide.image_path])
+        # Pillow only reads the image header, which is much cheaper than spawning identify
+        try:
+            with Image.open(self.slide.image_path) as image:
+                self.image_size = image.size
+                return
+        except (OSError, UnidentifiedImageError):
+            logging.debug(f'Pillow cannot read {self.slide.image_path}, falling back to identify')
+        output = _exec_output(['identify', '-format', '%w %h', self.slide.image_path])
         parts = output.split()
         self.image_size = int(parts[0]), int(parts[1])
 
-    def _slide_filename(self) -> str:
-        return f'out/slide_{self.slide_index:03d}.png'
-
     def _code_filename(self) -> str:
         return f'tmp/slide_{self.slide_index:03d}_code.png'
 
 
+def _slide_filename(slide_index: int) -> str:
+    return f'out/slide_{slide_index:03d}.png'
+
+
+def _link_or_copy(source: str, target: str):
+    _remove_file(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy(source, target)
+
+
+def _remove_file(filename: str):
+    if os.path.lexists(filename):
+        os.remove(filename)
+
+
+def _source_path(slide: Slide) -> Optional[str]:
+    if isinstance(slide, ImageSlide):
+        return slide.image_path
+    elif isinstance(slide, CodeSlide):
+        return slide.code_path
+    return None
+
+
+def _load_code(code_path: str) -> Tuple[str, Lexer]:
+    # Decode first, like pygmentize, so that lexers sharing an extension are told apart by the text
+    with open(code_path, 'rb') as f:
+        code, _ = guess_decode(f.read())
+    return code, get_lexer_for_filename(code_path, code)
+
+
 def _get_best_font(choices: List[str]) -> Optional[str]:
     available_fonts = _get_available_fonts()
     for choice in choices:
@@ -213,15 +407,85 @@ def _get_best_font(choices: List[str]) -> Optional[str]:
 
 @lru_cache
 def _get_available_fonts() -> List[str]:
-    output = _exec(['convert', '-list', 'font'])
+    cache_key = _font_cache_key()
+    fonts = _read_font_cache(cache_key)
+    if fonts is not None:
+        return fonts
+    output = _exec_output(['convert', '-list', 'font'])
     fonts = []
     for line in output.splitlines(keepends=False):
-        m = re.match(r'^\s+Font:\s(.*)$', line)
+        m = FONT_PATTERN.match(line)
         if m:
             fonts.append(m.group(1))
+    _write_font_cache(cache_key, fonts)
+    return fonts
+
+
+def _font_cache_filename() -> str:
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'hackerslides', 'fonts.json')
+
+
+def _font_cache_key() -> List:
+    paths = [shutil.which('convert'), *FONT_CACHE_DEPENDENCIES]
+    files = [[path, os.stat(path).st_mtime_ns] for path in paths if path is not None and os.path.exists(path)]
+    environment = [[name, os.environ.get(name)] for name in FONT_CACHE_ENVIRONMENT]
+    return files + environment
+
+
+def _read_font_cache(cache_key: List) -> Optional[List[str]]:
+    try:
+        with open(_font_cache_filename()) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != cache_key:
+        return None
+    created = cached.get('created')
+    if not isinstance(created, (int, float)) or time.time() - created > FONT_CACHE_MAX_AGE:
+        return None
+    fonts = cached.get('fonts')
+    if not isinstance(fonts, list) or not all(isinstance(font, str) for font in fonts):
+        return None
+    logging.debug('Using cached font list')
     return fonts
 
 
-def _exec(command: List[str]) -> str:
+def _write_font_cache(cache_key: List, fonts: List[str]):
+    filename = _font_cache_filename()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump({'key': cache_key, 'created': time.time(), 'fonts': fonts}, f)
+    except OSError as e:
+        logging.debug(f'Cannot write font cache {filename}: {e}')
+
+
+def _clear_font_cache():
+    _remove_file(_font_cache_filename())
+    _get_available_fonts.cache_clear()
+
+
+def _supports_opencl() -> bool:
+    output = _exec_output(['convert', '-list', 'configure'])
+    for line in output.splitlines(keepends=False):
+        if line.startswith('FEATURES'):
+            return 'OpenCL' in line.split()
+    return False
+
+
+def _exec(command: List[str]):
+    # The output of convert is not needed, so only capture stderr to report on
+    logging.debug(f'Executing command: {command}')
+    try:
+        result = subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        logging.error(f'Command {command[0]} failed: {e.stderr.decode(errors="replace").strip()}')
+        raise
+    if result.stderr:
+        logging.warning(result.stderr.decode(errors='replace').strip())
+
+
+def _exec_output(command: List[str]) -> str:
     logging.debug(f'Executing command: {command}')
     return subprocess.check_output(command, text=True)
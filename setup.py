@@ -1,9 +1,40 @@
-from setuptools import setup, find_packages
+import os
+
+from setuptools import setup, find_packages, Extension
+from setuptools.command.build_ext import build_ext
+
+# HACKERSLIDES_CYTHON=1 compiles the parser with Cython. It is off by default, because editable installs build the
+# extension in place, where it shadows any later edits to parser.py.
+CYTHON = os.environ.get('HACKERSLIDES_CYTHON') == '1'
+
+
+def cython_extensions():
+    if not CYTHON:
+        return []
+    return [Extension('hackerslides.parser', ['hackerslides/parser.py'])]
+
+
+class CythonBuildExt(build_ext):
+
+    def run(self):
+        # pip reads setup.py for the build requirements before it installs Cython, so it is only imported here
+        from Cython.Build import cythonize
+        cythonized = cythonize(self.extensions, compiler_directives={'language_level': 3})
+        for extension, cythonized_extension in zip(self.extensions, cythonized):
+            extension.sources = cythonized_extension.sources
+        super().run()
+
 
 setup(
     name='hackerslides',
     version='0.1',
     packages=find_packages(),
+    install_requires=[
+        'Pillow>=7',
+        'Pygments',
+    ],
+    ext_modules=cython_extensions(),
+    cmdclass={'build_ext': CythonBuildExt},
     entry_points={
         'console_scripts': ['hackerslides=hackerslides.cli:main'],
     },
@@ -1,9 +1,10 @@
+import io
 import textwrap
 
 import pytest
 
 from hackerslides.model import TextSlide, ImageSlide, SlideOptions, SlideStyle, CodeSlide
-from hackerslides.parser import parse, ParsingError
+from hackerslides.parser import parse, parse_lines, ParsingError
 
 DEFAULT_SLIDE_OPTIONS = SlideOptions(
     background='black',
@@ -28,6 +29,14 @@ def test_parses_minimal_presentation():
     assert presentation.slides[0] == TextSlide('Hello', options=DEFAULT_SLIDE_OPTIONS)
 
 
+def test_parses_empty_presentation():
+    # when
+    presentation = parse('')
+
+    # then
+    assert presentation.slides == ()
+
+
 def test_parses_multiline_text_slides():
     # given
     source = textwrap.dedent('''\
@@ -48,6 +57,37 @@ def test_parses_multiline_text_slides():
     assert presentation.slides[1] == TextSlide('Hello\n\n  World!', options=DEFAULT_SLIDE_OPTIONS)
 
 
+def test_splits_source_like_file(tmp_path):
+    # given
+    source = 'a\x0cb\r\n\nc\rd\u2028e\n'
+    path = tmp_path / 'slides.txt'
+    with open(path, 'w', newline='') as f:
+        f.write(source)
+
+    # when
+    presentation = parse(source)
+
+    # then
+    with open(path) as f:
+        assert presentation == parse_lines(f)
+    assert [slide.text for slide in presentation.slides] == ['a\x0cb', 'c\nd\u2028e']
+
+
+def test_shares_default_options_between_slides():
+    # given
+    source = textwrap.dedent('''\
+    Hello
+
+    World
+    ''')
+
+    # when
+    presentation = parse(source)
+
+    # then
+    assert presentation.slides[0].options is presentation.slides[1].options
+
+
 def test_ignores_comments():
     # given
     source = textwrap.dedent('''\
@@ -69,6 +109,24 @@ def test_ignores_comments():
     assert presentation.slides[1] == TextSlide('Hello # no comment\n# no comment', options=DEFAULT_SLIDE_OPTIONS)
 
 
+def test_parses_lines_from_file():
+    # given
+    source = io.StringIO(textwrap.dedent('''\
+    Hello
+    World
+
+    @img foo.png
+    '''))
+
+    # when
+    presentation = parse_lines(source)
+
+    # then
+    assert len(presentation.slides) == 2
+    assert presentation.slides[0] == TextSlide('Hello\nWorld', options=DEFAULT_SLIDE_OPTIONS)
+    assert presentation.slides[1] == ImageSlide(image_path='foo.png', options=DEFAULT_SLIDE_OPTIONS)
+
+
 def test_parses_minimal_image_slide():
     # given
     source = textwrap.dedent('''\
@@ -167,6 +225,22 @@ def test_parse_other_options():
                                                                     style=SlideStyle.DEFAULT, scale=0.5))
 
 
+def test_parse_style_by_name():
+    # given
+    source = textwrap.dedent('''\
+    :style meme
+
+    Hello
+    :style default
+    ''')
+
+    # when
+    presentation = parse(source)
+
+    # then
+    assert presentation.slides[0].options.style == SlideStyle.DEFAULT
+
+
 @pytest.mark.parametrize('source, line, message', [
     (textwrap.dedent('''\
     @foo sth
@@ -187,18 +261,57 @@ def test_parse_other_options():
     Text
     '''), 1, 'Text line not supported in code slide'),
     (textwrap.dedent('''\
+    @code foo.py
+    Text
+    @img bar.png
+    '''), 1, 'Text line not supported in code slide'),
+    (textwrap.dedent('''\
+    @code foo.py
+    @code bar.py
+    @img baz.png
+    '''), 1, 'Only one @code statement per slide is allowed'),
+    (textwrap.dedent('''\
+    @code foo.py
+    @img bar.png
+    '''), 0, '@code statement not supported in image slide'),
+    (textwrap.dedent('''\
     :foo
     '''), 0, 'Unknown keyword :foo'),
     (textwrap.dedent('''\
     :style foo
     '''), 0, 'Unknown style foo'),
     (textwrap.dedent('''\
+    :scale abc
+    '''), 0, 'Invalid scale abc'),
+    (textwrap.dedent('''\
+    :fg
+    '''), 0, 'Expected one argument for :fg statement'),
+    (textwrap.dedent('''\
+    :cover yes
+    '''), 0, 'Expected no argument for :cover statement'),
+    (textwrap.dedent('''\
     :style meme
     @img foo.png
     too
     many
     lines
     '''), 4, 'Image slide with style meme cannot have more than 2 lines of text'),
+    (textwrap.dedent('''\
+    :style meme
+
+    @img foo.png
+    too
+    many
+    lines
+    '''), 5, 'Image slide with style meme cannot have more than 2 lines of text'),
+    (textwrap.dedent('''\
+    :style meme
+    @img foo.png
+    too
+    many
+    lines
+    @img bar.png
+    '''), 4, 'Image slide with style meme cannot have more than 2 lines of text'),
 ])
 def test_parse_errors(source, line, message):
     with pytest.raises(ParsingError) as e:
@@ -206,3 +319,19 @@ def test_parse_errors(source, line, message):
 
     assert e.value.line == line
     assert str(e.value.message) == message
+
+
+def test_reports_error_without_reading_rest_of_slide():
+    # given
+    def lines():
+        yield '@code foo.py'
+        yield 'Text'
+        raise AssertionError('Read past the invalid line')
+
+    # when
+    with pytest.raises(ParsingError) as e:
+        parse_lines(lines())
+
+    # then
+    assert e.value.line == 1
+    assert str(e.value.message) == 'Text line not supported in code slide'
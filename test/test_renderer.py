@@ -0,0 +1,283 @@
+import os
+import time
+
+import pytest
+from PIL import Image
+
+from hackerslides import renderer
+from hackerslides.model import Configuration
+from hackerslides.parser import parse
+from hackerslides.renderer import ImageMagickRenderer, ImageMagickSlideRenderer, Fonts
+
+
+@pytest.fixture
+def commands(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(renderer, '_get_best_font', lambda fonts: None)
+    commands = []
+
+    def fake_exec(command):
+        # Remember which outputs existed when convert started, then write every output it names
+        outputs = [command[i + 1] for i, arg in enumerate(command) if arg == '-write'] + [command[-1]]
+        commands.append({'command': command, 'existing_outputs': [o for o in outputs if os.path.lexists(o)]})
+        for output in outputs:
+            with open(output, 'w') as f:
+                f.write(f'rendered {len(commands)}')
+
+    monkeypatch.setattr(renderer, '_exec', fake_exec)
+    return commands
+
+
+def render(*texts):
+    configuration = Configuration(path='slides.txt', resolution=(320, 240))
+    ImageMagickRenderer(configuration).render(parse('\n\n'.join(texts)))
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def test_second_run_uses_cached_slides(commands):
+    # given
+    render('Hello', 'World')
+
+    # when
+    render('Hello', 'World')
+
+    # then
+    assert len(commands) == 1
+    assert read('out/slide_000.png') == 'rendered 1'
+    assert read('out/slide_001.png') == 'rendered 1'
+
+
+def test_edited_slide_is_unlinked_before_rendering(commands):
+    # given
+    render('Hello')
+    cached_files = os.listdir('out/cache')
+
+    # when
+    render('Goodbye')
+
+    # then
+    assert len(commands) == 2
+    assert commands[1]['existing_outputs'] == []
+    assert read('out/slide_000.png') == 'rendered 2'
+    # The rendering of the previous version is still intact in the cache
+    assert [read(os.path.join('out/cache', f)) for f in cached_files] == ['rendered 1']
+
+
+def test_duplicate_slide_is_linked_to_first(commands):
+    # when
+    render('Hello', 'Hello')
+
+    # then
+    assert len(commands) == 1
+    assert commands[0]['command'][-1] == 'out/slide_000.png'
+    assert '-write' not in commands[0]['command']
+    assert os.path.samefile('out/slide_000.png', 'out/slide_001.png')
+
+
+def test_removes_slides_beyond_slide_count(commands):
+    # given
+    render('Hello', 'World', 'Again')
+
+    # when
+    render('Hello')
+
+    # then
+    assert sorted(os.listdir('out')) == ['cache', 'slide_000.png']
+
+
+def expire_cached_slides():
+    expired = time.time() - renderer.CACHE_MAX_AGE - 60
+    for filename in os.listdir('out/cache'):
+        os.utime(os.path.join('out/cache', filename), (expired, expired))
+
+
+def test_prunes_cached_slides_unused_for_a_long_time(commands):
+    # given
+    render('Old')
+    expire_cached_slides()
+
+    # when
+    render('New')
+
+    # then
+    assert [read(os.path.join('out/cache', f)) for f in os.listdir('out/cache')] == ['rendered 2']
+
+
+def test_keeps_recently_used_cached_slides(commands):
+    # given
+    render('Old')
+
+    # when
+    render('New')
+
+    # then
+    assert sorted(read(os.path.join('out/cache', f)) for f in os.listdir('out/cache')) == ['rendered 1', 'rendered 2']
+
+
+def test_keeps_expired_cached_slides_still_in_use(commands):
+    # given
+    render('Hello')
+    expire_cached_slides()
+
+    # when
+    render('Hello')
+
+    # then
+    assert len(commands) == 1
+    assert len(os.listdir('out/cache')) == 1
+    assert os.stat('out/slide_000.png').st_mtime > time.time() - renderer.CACHE_MAX_AGE
+
+
+def image_slide_renderer(image_path):
+    configuration = Configuration(path='slides.txt', resolution=(320, 240))
+    slide, = parse(f'@img {image_path}').slides
+    return ImageMagickSlideRenderer(configuration=configuration, slide=slide, slide_index=0,
+                                    fonts=Fonts(text=None, code=None, meme=None))
+
+
+def test_determines_image_size_with_pillow(tmp_path, monkeypatch):
+    # given
+    image_path = tmp_path / 'image.png'
+    Image.new('RGB', (640, 360)).save(image_path)
+    monkeypatch.setattr(renderer, '_exec_output', None)
+    slide_renderer = image_slide_renderer(image_path)
+
+    # when
+    slide_renderer._determine_raw_image_size()
+
+    # then
+    assert slide_renderer.image_size == (640, 360)
+
+
+def test_determines_image_size_with_identify_if_pillow_cannot_read_image(tmp_path, monkeypatch):
+    # given
+    image_path = tmp_path / 'image.svg'
+    image_path.write_text('<svg xmlns="http://www.w3.org/2000/svg" width="800" height="600"/>')
+    commands = []
+    monkeypatch.setattr(renderer, '_exec_output', lambda command: commands.append(command) or '800 600')
+    slide_renderer = image_slide_renderer(image_path)
+
+    # when
+    slide_renderer._determine_raw_image_size()
+
+    # then
+    assert slide_renderer.image_size == (800, 600)
+    assert commands == [['identify', '-format', '%w %h', str(image_path)]]
+
+
+@pytest.mark.parametrize('filename, code, lexer_name', [
+    ('foo.h', '#include <stdio.h>\n\nint main(void);\n', 'C'),
+    ('foo.m', '% Compute\nx = 1;\ndisp(x)\n', 'Matlab'),
+    ('foo.py', 'print("hé")\n', 'Python'),
+])
+def test_loads_code_like_pygmentize(tmp_path, filename, code, lexer_name):
+    # given
+    code_path = tmp_path / filename
+    code_path.write_bytes(code.encode())
+
+    # when
+    loaded_code, lexer = renderer._load_code(str(code_path))
+
+    # then
+    assert loaded_code == code
+    assert lexer.name == lexer_name
+
+
+FONT_LIST = '''\
+  Font: DejaVu-Sans
+    family: DejaVu Sans
+  Font: Impact
+    family: Impact
+'''
+
+
+@pytest.fixture
+def font_listings(tmp_path, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    fontconfig_cache = tmp_path / 'fontconfig'
+    fontconfig_cache.mkdir()
+    monkeypatch.setattr(renderer, 'FONT_CACHE_DEPENDENCIES', [str(fontconfig_cache)])
+    listings = []
+    monkeypatch.setattr(renderer, '_exec_output', lambda command: listings.append(command) or FONT_LIST)
+    renderer._get_available_fonts.cache_clear()
+    yield listings
+    renderer._get_available_fonts.cache_clear()
+
+
+def list_fonts():
+    renderer._get_available_fonts.cache_clear()
+    return renderer._get_available_fonts()
+
+
+def write_font_cache(content):
+    filename = renderer._font_cache_filename()
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(content)
+
+
+def test_reuses_cached_font_list(font_listings):
+    # given
+    list_fonts()
+
+    # when
+    fonts = list_fonts()
+
+    # then
+    assert fonts == ['DejaVu-Sans', 'Impact']
+    assert font_listings == [['convert', '-list', 'font']]
+
+
+def test_lists_fonts_again_when_fontconfig_cache_changes(font_listings, tmp_path):
+    # given
+    list_fonts()
+    os.utime(tmp_path / 'fontconfig', ns=(0, 0))
+
+    # when
+    fonts = list_fonts()
+
+    # then
+    assert fonts == ['DejaVu-Sans', 'Impact']
+    assert len(font_listings) == 2
+
+
+def test_lists_fonts_again_when_cached_list_expired(font_listings, monkeypatch):
+    # given
+    list_fonts()
+    later = time.time() + renderer.FONT_CACHE_MAX_AGE + 60
+    monkeypatch.setattr(time, 'time', lambda: later)
+
+    # when
+    list_fonts()
+
+    # then
+    assert len(font_listings) == 2
+
+
+@pytest.mark.parametrize('content', ['not json', '[]', '{"key": null}', '{"fonts": "Impact"}'])
+def test_lists_fonts_again_when_cache_is_invalid(font_listings, content):
+    # given
+    write_font_cache(content)
+
+    # when
+    fonts = list_fonts()
+
+    # then
+    assert fonts == ['DejaVu-Sans', 'Impact']
+    assert len(font_listings) == 1
+
+
+def test_refreshes_font_list_on_request(font_listings):
+    # given
+    list_fonts()
+
+    # when
+    ImageMagickRenderer(Configuration(path='slides.txt', resolution=(320, 240), refresh_fonts=True))
+    list_fonts()
+
+    # then
+    assert len(font_listings) == 2